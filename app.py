@@ -1,24 +1,30 @@
 import uvicorn
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Depends, Header, Form, File, UploadFile
 import httpx
+import orjson
 import os
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-import base64
+import pybase64
+import hashlib
 from io import BytesIO, StringIO
 from pypdf import PdfReader, PdfWriter
 from datetime import datetime, timedelta
 import csv
-from fastapi.responses import StreamingResponse
-from typing import List, Dict, Any
+import tempfile
+from pathlib import Path
+from fastapi.responses import StreamingResponse, ORJSONResponse, Response
+from typing import List, Dict, Any, Literal, AsyncIterator
+from contextlib import asynccontextmanager
+from urllib.parse import urlencode
+import asyncio
+import time
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-
 # Load environment variables from a .env file
 load_dotenv()  # defaults to .env in current directory
 
@@ -34,9 +40,25 @@ DOCS_LIST_ID = os.getenv("DOCS_LIST_ID")
 # The token endpoint for OAuth 2.0 client_credentials flow
 TOKEN_URL = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
 
-# This is the API endpoint for retrieving the list of folders/items
+# The client_credentials form never changes, so it is encoded once here
+TOKEN_REQUEST_BODY = urlencode({
+    "client_id": CLIENT_ID,
+    "client_secret": CLIENT_SECRET,
+    "scope": "https://graph.microsoft.com/.default",
+    "grant_type": "client_credentials",
+}).encode()
+
+# This is the API endpoint for retrieving the list of folders/items.
+# $select / fields($select=...) limit each item to the properties parse_items
+# reads, instead of every column in the library. Expanding driveItem brings
+# each item's drive IDs along, so copies and conversions need no separate
+# .../driveItem lookup. $top asks for the largest page Graph allows so big
+# libraries need few @odata.nextLink follow-ups.
 FOLDER_LIST_URL = (
-    f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/lists/Documents/items?expand=fields"
+    f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/lists/Documents/items"
+    "?$select=id,eTag,parentReference"
+    "&expand=fields($select=id,FileLeafRef,ContentType),driveItem($select=id,parentReference)"
+    "&$top=5000"
 )
 
 # SharePoint file upload API template
@@ -44,6 +66,89 @@ SHAREPOINT_UPLOAD_URL_TEMPLATE = (
     "https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/items/{parent_id}:/{file_name}:/content"
 )
 
+# Cached OAuth2 token; refreshed shortly before it expires (see get_access_token).
+# The lock makes concurrent requests share a single refresh.
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
+_token_cache = {"access_token": None, "expires_at": 0.0}
+_token_lock = asyncio.Lock()
+
+# Short-lived cache of the Documents list and the hierarchy built from it
+# (see get_folder_items). Folder creation, template copies, uploads and
+# deletes through this API invalidate it; "generation" counts invalidations so
+# a fetch that was already in flight is not cached as fresh.
+FOLDER_CACHE_TTL_SECONDS = float(os.getenv("FOLDER_CACHE_TTL_SECONDS", "30"))
+_folder_cache = {"entry": None, "etag": None, "expires_at": 0.0, "generation": 0}
+_folder_cache_lock = asyncio.Lock()
+# Above this many bytes of list JSON, decoding and indexing run in a worker
+# thread; below it the thread hand-off costs more than it saves.
+OFFLOAD_PARSE_BYTES = 256_000
+# Total bytes of encoded /subfolders payloads to keep per cache entry. Sub-trees
+# near the root are nearly as large as the whole tree, so this is a byte budget
+# rather than a count.
+SUBTREE_JSON_CACHE_BYTES = 16 << 20
+# Browsers must revalidate navigation responses (cheaply, with If-None-Match)
+# on every use, so a folder created, uploaded or deleted through this API
+# shows up straight away rather than after a browser-side max-age.
+FOLDER_CACHE_CONTROL = "private, no-cache"
+
+# Base64 payloads are decoded in worker threads; this caps how many decodes
+# (and their decoded copies) are in flight at once.
+_base64_decode_semaphore = asyncio.BoundedSemaphore(os.cpu_count() or 2)
+
+# /upload_files and /delete_files take at most BATCH_MAX_FILES files per call
+# and send at most BATCH_CONCURRENCY of them to Graph at a time, which keeps a
+# batch under Graph's throttling limits and bounds the decoded uploads held.
+BATCH_MAX_FILES = 20
+BATCH_CONCURRENCY = 4
+
+# Set DEBUG_SAVE_PDF=1 to also write each merged PDF to testing/<server_id>_combined.pdf
+DEBUG_SAVE_PDF = os.getenv("DEBUG_SAVE_PDF", "").lower() in ("1", "true", "yes")
+
+# pypdf merges are CPU-bound and run in worker threads; this caps how many
+# run (and hold both input PDFs in memory) at once.
+_pdf_merge_semaphore = asyncio.BoundedSemaphore(os.cpu_count() or 2)
+
+# Rows per chunk when streaming the /process_timesheets CSV
+CSV_CHUNK_ROWS = 500
+
+# Converted PDFs are downloaded in chunks of this size into a spooled buffer
+# that moves to a temporary file once it passes PDF_SPOOL_MAX_BYTES.
+PDF_DOWNLOAD_CHUNK_BYTES = 1 << 16
+PDF_SPOOL_MAX_BYTES = 8 << 20
+
+# Shared HTTP client, created on startup and closed on shutdown (see lifespan).
+# Reusing one pooled client keeps TCP/TLS connections to Graph and the token
+# endpoint alive between requests instead of re-handshaking on every call, and
+# HTTP/2 lets concurrent Graph requests share a single connection.
+http_client: httpx.AsyncClient | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+        http_client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    FastAPI dependency returning the shared, pooled httpx client.
+    """
+    if http_client is None:
+        raise RuntimeError("HTTP client is not initialised; the app lifespan has not started.")
+    return http_client
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
 # ================================
 # Pydantic Models
 # ================================
@@ -88,212 +193,138 @@ class TimesheetRequest(BaseModel):
 class DeleteFileRequest(BaseModel):
     file_url: str  # The delete_url returned from upload_file endpoint (or legacy webUrl for backward compatibility)
 
+class BatchUploadRequest(BaseModel):
+    files: List[FileUploadRequest] = Field(max_length=BATCH_MAX_FILES)
+
+class DeleteFilesRequest(BaseModel):
+    file_urls: List[str] = Field(max_length=BATCH_MAX_FILES)  # delete_url values (or legacy webUrls), as for DeleteFileRequest
+
 # ================================
 # Main Endpoints
 # ================================
 @app.post("/upload_file")
-async def upload_file(request: FileUploadRequest):
+async def upload_file(request: FileUploadRequest, client: httpx.AsyncClient = Depends(get_client)):
     """
     Uploads a base64-encoded file to a given SharePoint folder (server_id).
     """
-    access_token = await get_access_token()
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/octet-stream"
-    }
-
     # Decode the base64 file content 
     try:
-        file_content = base64.b64decode(request.file_data)
+        file_content = await decode_base64(request.file_data)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid base64 file data")
 
-    # Construct SharePoint file upload URL
-    upload_url = SHAREPOINT_UPLOAD_URL_TEMPLATE.format(
-        site_id=SITE_ID,
-        drive_id=DOCUMENTS_DRIVE_ID,    
-        parent_id=request.server_id,
-        file_name=request.file_name
-    )
+    return await upload_to_sharepoint(client, request.file_name, request.server_id, file_content)
 
-    # Upload the file to SharePoint
-    async with httpx.AsyncClient() as client:
-        response = await client.put(upload_url, headers=headers, content=file_content)
 
-    if response.status_code not in (200, 201):
-        raise HTTPException(status_code=response.status_code, detail=response.text)
+@app.post("/upload_files")
+async def upload_files(request: BatchUploadRequest, client: httpx.AsyncClient = Depends(get_client)):
+    """
+    Uploads up to BATCH_MAX_FILES base64-encoded files in one call,
+    BATCH_CONCURRENCY at a time. Every file is decoded before anything is uploaded, so invalid base64 is a
+    400 with nothing written. Otherwise returns one result per file, in
+    request order (see batch_results); a failed upload does not stop the others.
+    """
+    decoded = await asyncio.gather(
+        *(decode_base64(file.file_data) for file in request.files), return_exceptions=True
+    )
+    invalid = [file.file_name for file, content in zip(request.files, decoded) if isinstance(content, Exception)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid base64 file data for: {', '.join(invalid)}")
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    outcomes = await asyncio.gather(
+        *(
+            run_limited(semaphore, upload_to_sharepoint(client, file.file_name, file.server_id, file_content))
+            for file, file_content in zip(request.files, decoded)
+        ),
+        return_exceptions=True,
+    )
+    return batch_results(outcomes)
 
-    response_data = response.json()
-    
-    # Store the item ID for reliable deletion and construct a standard URL
-    item_id = response_data.get("id")
-    
-    # Get the parent path and filename to construct a consistent URL
-    parent_reference = response_data.get("parentReference", {})
-    parent_path = parent_reference.get("path", "").replace("/drive/root:", "")
-    file_name = response_data.get("name", request.file_name)
-    
-    # Construct a standard SharePoint document library URL format
-    # This format works for deletion regardless of file type
-    if parent_path:
-        file_path = f"{parent_path}/{file_name}"
-    else:
-        file_path = file_name
-    
-    # Remove leading slash if present
-    if file_path.startswith("/"):
-        file_path = file_path[1:]
-    
-    # Get the direct webUrl from SharePoint response
-    direct_web_url = response_data.get("webUrl")
-    
-    # Construct SharePoint viewer URL that opens in browser instead of downloading
-    if direct_web_url:
-        from urllib.parse import urlparse, quote, unquote
-        
-        # Get file extension to determine viewer URL format
-        file_extension = file_name.lower().split('.')[-1] if '.' in file_name else ''
-        
-        if file_extension in ['docx', 'doc', 'xlsx', 'xls', 'pptx', 'ppt']:
-            # For Office documents, SharePoint already returns the correct viewer URL
-            viewer_url = direct_web_url
-        else:
-            # For other files (like PDFs), modify the URL to open in browser view
-            parsed_url = urlparse(direct_web_url)
-            
-            # Check if it's already a viewer URL, if not, add web=1 parameter
-            if '?web=' not in direct_web_url and '&web=' not in direct_web_url:
-                separator = '&' if '?' in direct_web_url else '?'
-                viewer_url = f"{direct_web_url}{separator}web=1"
-            else:
-                viewer_url = direct_web_url
-    else:
-        # Construct fallback URL if webUrl is not available
-        viewer_url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DOCUMENTS_DRIVE_ID}/items/{item_id}"
-    
-    # Create internal file_url for deletion (with item_id)
-    internal_file_url = f"item_id:{item_id}|path:{file_path}"
 
-    return {
-        "message": "File uploaded successfully", 
-        "file_url": viewer_url,  # SharePoint viewer URL that opens in browser
-        "delete_url": internal_file_url  # Internal URL for deletion
-    }
+@app.post("/upload_file_binary")
+async def upload_file_binary(
+    server_id: str = Form(...),
+    file: UploadFile = File(...),
+    file_name: str | None = Form(None),
+    client: httpx.AsyncClient = Depends(get_client),
+):
+    """
+    Uploads a file sent as multipart/form-data to a given SharePoint folder (server_id).
+    Returns the same response as /upload_file, but avoids base64 entirely: the
+    upload is streamed to SharePoint in chunks. file_name defaults to the
+    uploaded file's own name.
+    """
+    file_name = file_name or file.filename
+    if not file_name:
+        raise HTTPException(status_code=400, detail="A file_name is required")
+
+    return await upload_to_sharepoint(
+        client, file_name, server_id, iter_upload_file(file), content_length=file.size
+    )
 
 
 @app.post("/delete_file")
-async def delete_file(request: DeleteFileRequest):
+async def delete_file(request: DeleteFileRequest, client: httpx.AsyncClient = Depends(get_client)):
     """
     Deletes a file from SharePoint using the file_url returned from upload_file.
     Supports both new item_id format and legacy webUrl format.
     """
-    access_token = await get_access_token()
-    headers = {"Authorization": f"Bearer {access_token}"}
-    
-    try:
-        delete_url = None
-        
-        # Check if this is the new format with item_id
-        if request.file_url.startswith("item_id:"):
-            # Extract item_id from the new format
-            parts = request.file_url.split("|")
-            item_id = parts[0].replace("item_id:", "")
-            
-            # Use the item ID for direct deletion - more reliable
-            delete_url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DOCUMENTS_DRIVE_ID}/items/{item_id}"
-            
-            logger.info(f"Attempting to delete file by item ID: {item_id}")
-            
-        else:
-            # Legacy webUrl format - parse the URL to extract the relative path
-            from urllib.parse import urlparse, unquote
-            parsed_url = urlparse(request.file_url)
-            
-            # Extract the path after "Shared Documents" or "Documents"
-            path_parts = unquote(parsed_url.path).split('/')
-            
-            # Find the index of "Documents" in the path
-            docs_index = -1
-            for i, part in enumerate(path_parts):
-                if part in ["Documents", "Shared%20Documents", "Shared Documents"]:
-                    docs_index = i
-                    break
-            
-            if docs_index == -1:
-                raise HTTPException(status_code=400, detail="Invalid file URL format - could not find Documents folder")
-            
-            # Get the relative path after Documents
-            relative_path = '/'.join(path_parts[docs_index + 1:])
-            
-            if not relative_path:
-                raise HTTPException(status_code=400, detail="Invalid file URL - no file path found")
-            
-            # Construct the Graph API delete URL
-            delete_url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DOCUMENTS_DRIVE_ID}/root:/{relative_path}"
-            
-            logger.info(f"Attempting to delete file at path: {relative_path}")
-        
-        # Delete the file
-        async with httpx.AsyncClient() as client:
-            response = await client.delete(delete_url, headers=headers)
-            
-            if response.status_code == 204:
-                return {"message": "File deleted successfully", "file_url": request.file_url}
-            elif response.status_code == 404:
-                raise HTTPException(status_code=404, detail="File not found")
-            else:
-                logger.error(f"Delete failed with status {response.status_code}: {response.text}")
-                response.raise_for_status()
-                
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error deleting file: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error deleting file: {str(e)}")
+    return await delete_from_sharepoint(client, request.file_url)
 
 
-@app.get("/folders")
-async def get_folders():
+@app.post("/delete_files")
+async def delete_files(request: DeleteFilesRequest, client: httpx.AsyncClient = Depends(get_client)):
     """
-    1. Acquire OAuth2 token with client credentials.
-    2. Pull folder items from Microsoft Graph.
-    3. Build and return a nested folder hierarchy.
+    Deletes up to BATCH_MAX_FILES files (delete_url or legacy webUrl each),
+    BATCH_CONCURRENCY at a time. Returns one result per file, in request order (see batch_results); a
+    failed delete does not stop the others.
     """
-    access_token = await get_access_token()
-    headers = {"Authorization": f"Bearer {access_token}"}
-    async with httpx.AsyncClient() as client:
-        folder_resp = await client.get(FOLDER_LIST_URL, headers=headers)
-        folder_resp.raise_for_status()
-        all_items = folder_resp.json().get("value", [])
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    outcomes = await asyncio.gather(
+        *(run_limited(semaphore, delete_from_sharepoint(client, file_url)) for file_url in request.file_urls),
+        return_exceptions=True,
+    )
+    return batch_results(outcomes)
+
 
-    # Build the entire tree
-    hierarchy = build_folder_hierarchy(all_items)
-    return hierarchy
+@app.get("/folders")
+async def get_folders(
+    include_raw: bool = Query(False, description="Include the full Graph item on each node as 'rawItem'"),
+    if_none_match: str | None = Header(None),
+    client: httpx.AsyncClient = Depends(get_client),
+):
+    """
+    1. Pull folder items from Microsoft Graph (or the short-lived cache).
+    2. Return the nested folder hierarchy built from them.
+    """
+    folders = await get_folder_items(client)
+    if include_raw:
+        return build_folder_hierarchy(folders["items"], include_raw=True)
+    payload, etag = encoded_folder_json(folders)
+    return json_payload_response(payload, etag, if_none_match)
 
 
 @app.get("/subfolders/{server_id}")
-async def get_subfolders(server_id: str):
+async def get_subfolders(
+    server_id: str,
+    if_none_match: str | None = Header(None),
+    client: httpx.AsyncClient = Depends(get_client),
+):
     """
     Given a unique 'server_id' (GUID from @odata.etag),
     return the sub-tree for that folder. If not found, return 404.
     """
-    access_token = await get_access_token()
-    headers = {"Authorization": f"Bearer {access_token}"}
-    async with httpx.AsyncClient() as client:
-        folder_resp = await client.get(FOLDER_LIST_URL, headers=headers)
-        folder_resp.raise_for_status()
-        all_items = folder_resp.json().get("value", [])
-
-    hierarchy = build_folder_hierarchy(all_items)
-    matching_node = find_folder_by_id_in_hierarchy(hierarchy, server_id)
-    if not matching_node:
+    folders = await get_folder_items(client)
+    if server_id not in folders["by_id"]:
         raise HTTPException(status_code=404, detail="Folder not found.")
 
-    return matching_node
+    payload, etag = encoded_folder_json(folders, server_id)
+    return json_payload_response(payload, etag, if_none_match)
 
 
 @app.post("/create_folder")
-async def create_folder(req: FolderRequest):
+async def create_folder(req: FolderRequest, client: httpx.AsyncClient = Depends(get_client)):
     """
     Creates a new folder in a known 'Documents' drive inside a specific subfolder.
     """
@@ -315,64 +346,38 @@ async def create_folder(req: FolderRequest):
     }
 
     # 4) Create the folder
-    async with httpx.AsyncClient() as client:
-        response = await client.post(create_folder_url, headers=headers, json=payload)
-        response.raise_for_status()
+    response = await client.post(create_folder_url, headers=headers, json=payload)
+    response.raise_for_status()
+    invalidate_folder_cache()
 
     return response.json()
 
 
 @app.post("/copy_template_folder")
-async def copy_template_folder(req: CopyFolderRequest):
+async def copy_template_folder(req: CopyFolderRequest, client: httpx.AsyncClient = Depends(get_client)):
     """
     1) Accepts a destination folder's "server ID" (from the SharePoint list).
-    2) Translates that server ID -> numeric item ID -> driveItem ID.
+    2) Translates that server ID -> driveItem ID.
     3) Copies the hard-coded template folder to that driveItem.
     """
-    access_token = await get_access_token()
+    # 2) Look up the node for the given server ID in the folder hierarchy,
+    #    fetching the token for the later Graph calls at the same time
+    access_token, folders = await asyncio.gather(
+        get_access_token(), get_folder_items(client)
+    )
     headers = {"Authorization": f"Bearer {access_token}"}
-
-    # 2) Fetch the entire folder hierarchy to find the rawItem for the given server ID
-    async with httpx.AsyncClient() as client:
-        all_items_resp = await client.get(
-            f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/lists/Documents/items?expand=fields",
-            headers=headers
-        )
-        all_items_resp.raise_for_status()
-        all_items = all_items_resp.json().get("value", [])
-
-    hierarchy = build_folder_hierarchy(all_items)
-    matching_node = find_folder_by_id_in_hierarchy(hierarchy, req.destination_server_id)
-    if not matching_node:
+    if req.destination_server_id not in folders["by_id"]:
         raise HTTPException(status_code=404, detail="Destination folder not found.")
 
-    # 3) Extract the numeric list item ID
-    raw_item = matching_node["rawItem"]
-    fields = raw_item.get("fields", {})
-    numeric_item_id = fields.get("id")  # integer ID for the list item
-    if not numeric_item_id:
-        raise HTTPException(
-            status_code=400,
-            detail="Could not find the numeric list item ID from fields['ID']."
-        )
-
-    # 4) Convert numeric item ID to a driveItem ID
-    list_item_drive_item_url = (
-        f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/lists/{DOCS_LIST_ID}/items/{numeric_item_id}/driveItem"
-    )
-    async with httpx.AsyncClient() as client:
-        drive_item_resp = await client.get(list_item_drive_item_url, headers=headers)
-        drive_item_resp.raise_for_status()
-        drive_item_data = drive_item_resp.json()
-    
-    parent_drive_item_id = drive_item_data.get("id")
+    # 3) The driveItem ID comes expanded on the list item
+    parent_drive_item_id = folders["drive_items"].get(req.destination_server_id, {}).get("id")
     if not parent_drive_item_id:
         raise HTTPException(
             status_code=400,
             detail="Could not retrieve a valid driveItem.id for the destination folder."
         )
 
-    # 5) Copy using the driveItem ID
+    # 4) Copy using the driveItem ID
     copy_url = (
         f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DOCUMENTS_DRIVE_ID}/items/{TEMPLATE_FOLDER_ID}/copy"
     )
@@ -384,177 +389,115 @@ async def copy_template_folder(req: CopyFolderRequest):
         "name": "Copied_Template_Folder"
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(copy_url, headers=headers, json=payload)
-        # Microsoft Graph returns 202 if accepted
-        if response.status_code == 202:
-            return {
-                "status": "Copy in progress",
-                "message": "The template folder is being copied."
-            }
-        else:
-            response.raise_for_status()
-            return response.json()
+    response = await client.post(copy_url, headers=headers, json=payload)
+    invalidate_folder_cache()
+    # Microsoft Graph returns 202 if accepted
+    if response.status_code == 202:
+        return {
+            "status": "Copy in progress",
+            "message": "The template folder is being copied."
+        }
+    else:
+        response.raise_for_status()
+        return response.json()
 
 
 @app.get("/folders_get_children/{server_id}")
-async def folders_get_children(server_id: str):
+async def folders_get_children(
+    server_id: str,
+    if_none_match: str | None = Header(None),
+    client: httpx.AsyncClient = Depends(get_client),
+):
     """
     Return details of the current folder (by server_id) and its immediate subfolders.
     """
-    access_token = await get_access_token()
-    headers = {"Authorization": f"Bearer {access_token}"}
-
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(FOLDER_LIST_URL, headers=headers)
-        resp.raise_for_status()
-        all_items = resp.json().get("value", [])
-
-    # Helper
-    def extract_server_id(item):
-        etag_str = item.get("@odata.etag", "")
-        return etag_str.strip('"').split(",")[0]
+    folders = await get_folder_items(client)
+    by_id = folders["by_id"]
 
     # 1) Locate the item
-    queried_item = next(
-        (item for item in all_items if extract_server_id(item) == server_id),
-        None
-    )
-    if not queried_item:
+    queried_node = by_id.get(server_id)
+    if not queried_node:
         raise HTTPException(status_code=404, detail="Folder not found.")
 
     # 2) Extract parent
-    queried_folder_parent_id = queried_item.get("parentReference", {}).get("id")
-    queried_folder_name = queried_item.get("fields", {}).get("FileLeafRef")
+    queried_folder_parent_id = queried_node["parentID"]
+    queried_folder_name = queried_node["name"]
 
     # 3) Locate the parent item (if any)
     queried_folder_parent_name = None
     if queried_folder_parent_id:
-        parent_item = next(
-            (item for item in all_items if extract_server_id(item) == queried_folder_parent_id),
-            None
-        )
-        if parent_item:
-            queried_folder_parent_name = parent_item.get("fields", {}).get("FileLeafRef")
+        parent_node = by_id.get(queried_folder_parent_id)
+        if parent_node:
+            queried_folder_parent_name = parent_node["name"]
 
     # 4) Collect immediate child folders
     child_folders = []
-    for item in all_items:
-        parent_id = item.get("parentReference", {}).get("id")
-        content_type = item.get("fields", {}).get("ContentType")
-        if parent_id == server_id and content_type == "Folder":
+    for node in folders["children_of"].get(server_id, []):
+        if node["contentType"] == "Folder":
             child_folders.append({
-                "name": item.get("fields", {}).get("FileLeafRef"),
-                "serverId": extract_server_id(item)
+                "name": node["name"],
+                "serverId": node["serverID"]
             })
     
     child_folders.sort(key=lambda x: x["name"].lower())
     # 5) Return
-    return {
+    payload = orjson.dumps({
         "queriedFolderParentId": queried_folder_parent_id,
         "queriedFolderParentName": queried_folder_parent_name,
         "queriedFolderServerId": server_id,
         "queriedFolderName": queried_folder_name,
         "childrenFolders": child_folders
-    }
+    })
+    return json_payload_response(payload, payload_etag(payload), if_none_match)
 
 @app.post("/convert_doc_to_pdf/{server_id}")
-async def convert_doc_to_pdf(server_id: str, req: CombinePDFRequest):
+async def convert_doc_to_pdf(
+    server_id: str,
+    req: CombinePDFRequest,
+    encoding: Literal["base64", "pdf"] = Query(
+        "base64",
+        description="'base64' returns JSON with the PDF base64-encoded; "
+                    "'pdf' returns the raw application/pdf body",
+    ),
+    client: httpx.AsyncClient = Depends(get_client),
+):
     """
     1) Takes a 'server_id' for an existing Word doc in SharePoint.
     2) Converts it to PDF (via Microsoft Graph).
     3) Decodes the user-provided PDF from 'pdf_to_append_b64'.
     4) Appends that PDF to the newly converted PDF (end-to-end).
-    5) Returns the combined PDF as base64.
+    5) Returns the combined PDF as base64 JSON, or as application/pdf with
+       ?encoding=pdf (the SharePoint link is then in X-SharePoint-File-Url).
     """
-    access_token = await get_access_token()
-    headers = {"Authorization": f"Bearer {access_token}"}
-
-    # 1) Get the entire set of list items to locate this file
-    async with httpx.AsyncClient() as client:
-        all_items_resp = await client.get(FOLDER_LIST_URL, headers=headers)
-        all_items_resp.raise_for_status()
-        all_items = all_items_resp.json().get("value", [])
-
-    # 2) Find the file item
-    matching_node = find_folder_by_id_in_hierarchy(build_folder_hierarchy(all_items), server_id)
-    if not matching_node:
-        raise HTTPException(status_code=404, detail="Could not find an item with this server_id.")
-
-    raw_item = matching_node["rawItem"]
-    fields = raw_item.get("fields", {})
-    numeric_item_id = fields.get("id")  # integer ID for the list item
-    if fields.get("ContentType") != "Document":
-        raise HTTPException(status_code=400, detail="The specified item is not a document.")
-    if not numeric_item_id:
-        raise HTTPException(status_code=400, detail="Could not find numeric list item ID.")
-
-    # 3) Convert numeric item ID -> driveItem ID
-    list_item_drive_item_url = (
-        f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}"
-        f"/lists/{DOCS_LIST_ID}/items/{numeric_item_id}/driveItem"
-    )
-    async with httpx.AsyncClient() as client:
-        drive_item_resp = await client.get(list_item_drive_item_url, headers=headers)
-        drive_item_resp.raise_for_status()
-        drive_item_data = drive_item_resp.json()
-
-    drive_item_id = drive_item_data.get("id")
-    if not drive_item_id:
-        raise HTTPException(status_code=400, detail="Could not retrieve driveItem.id for the file.")
-
-    # 4) Request the doc as PDF
-    pdf_url = (
-        f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DOCUMENTS_DRIVE_ID}"
-        f"/items/{drive_item_id}/content?format=pdf"
-    )
-    async with httpx.AsyncClient(follow_redirects=True) as client:
-        pdf_resp = await client.get(pdf_url, headers=headers)
-        if pdf_resp.status_code != 200:
-            raise HTTPException(
-                status_code=pdf_resp.status_code,
-                detail=f"Conversion failed. Graph error: {pdf_resp.text}",
-            )
-        word_doc_pdf_bytes = pdf_resp.content
+    # Decode the user's PDF in a worker thread while Graph locates and
+    # converts the document
+    append_pdf_task = asyncio.create_task(decode_base64(req.pdf_to_append_b64))
+    try:
+        word_doc_pdf_file, drive_item_data = await fetch_document_pdf(client, server_id)
+    except BaseException:
+        append_pdf_task.cancel()
+        raise
 
-    # 5) Decode user's PDF from base64
+    # 5) Collect the user's PDF decoded from base64
     try:
-        append_pdf_bytes = base64.b64decode(req.pdf_to_append_b64)
+        append_pdf_bytes = await append_pdf_task
     except Exception:
+        word_doc_pdf_file.close()
         raise HTTPException(status_code=400, detail="Invalid base64 PDF to append.")
 
-    # 6) Combine the two PDFs in memory
+    # 6) Combine the two PDFs in memory, off the event loop
     try:
-        # Read the newly converted doc PDF
-        doc_pdf_reader = PdfReader(BytesIO(word_doc_pdf_bytes))
-        # Read the PDF to append
-        append_pdf_reader = PdfReader(BytesIO(append_pdf_bytes))
+        async with _pdf_merge_semaphore:
+            merged_pdf_bytes = await asyncio.to_thread(merge_pdfs, word_doc_pdf_file, append_pdf_bytes)
 
-        # Prepare a single writer
-        pdf_writer = PdfWriter()
-        
-        # Copy pages from doc_pdf_reader
-        for page in doc_pdf_reader.pages:
-            pdf_writer.add_page(page)
-        # Then from append_pdf_reader
-        for page in append_pdf_reader.pages:
-            pdf_writer.add_page(page)
-
-        # Write to memory
-        merged_pdf_io = BytesIO()
-        pdf_writer.write(merged_pdf_io)
-        merged_pdf_io.seek(0)
-        merged_pdf_bytes = merged_pdf_io.read()
-
-        #write to local
-        local_filename = f"testing/{server_id}_combined.pdf"
-        with open(local_filename, "wb") as f:
-            f.write(merged_pdf_bytes)
-
-        # Base64-encode the final PDF
-        final_pdf_base64 = base64.b64encode(merged_pdf_bytes).decode("utf-8")
+        if DEBUG_SAVE_PDF:
+            # Keep a local copy for inspection; off by default
+            local_path = Path("testing") / f"{server_id}_combined.pdf"
+            await asyncio.to_thread(local_path.write_bytes, merged_pdf_bytes)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error combining PDFs: {str(e)}")
+    finally:
+        word_doc_pdf_file.close()
 
    # Identify the parent folder's driveItem ID so we can place the merged PDF there
     parent_drive_item_id = drive_item_data.get("parentReference", {}).get("id")
@@ -564,24 +507,31 @@ async def convert_doc_to_pdf(server_id: str, req: CombinePDFRequest):
             detail="Could not find the parent folder's driveItem ID."
         )
 
-    # 7) UPLOAD the merged PDF to the same folder using the existing '/upload_file' logic.
-    #    We'll re-encode 'merged_pdf_bytes' as base64 and let `upload_file` handle the rest.
-    from typing import cast
-    upload_request_data = FileUploadRequest(
-        file_name=f"{server_id}_combined.pdf",
-        server_id=parent_drive_item_id,  # same parent folder as original doc
-        file_data=base64.b64encode(merged_pdf_bytes).decode("utf-8")
+    # 7) UPLOAD the merged PDF to the same folder using the same logic as '/upload_file',
+    #    passing the raw bytes straight through (no base64 round trip).
+    upload_response = await upload_to_sharepoint(
+        client,
+        f"{server_id}_combined.pdf",
+        parent_drive_item_id,  # same parent folder as original doc
+        merged_pdf_bytes,
     )
-
-    # We call our existing /upload_file function *directly*. 
-    # This is an async function, so we must await it.
-    upload_response = await upload_file(upload_request_data)
     # e.g. upload_response -> { "message": "...", "file_url": "<clickable SharePoint link>", "delete_url": "<internal ID>" }
     sharepoint_file_url = upload_response.get("file_url", None)
 
     # 8) Return the final PDF + the new SharePoint file URL
+    if encoding == "pdf":
+        # Raw body: no base64 pass and no 4/3-size JSON string
+        return Response(
+            content=merged_pdf_bytes,
+            media_type="application/pdf",
+            headers={
+                "Content-Disposition": f'attachment; filename="{server_id}_combined.pdf"',
+                "X-SharePoint-File-Url": sharepoint_file_url or "",
+            },
+        )
+
     return {
-        "combined_pdf_base64": final_pdf_base64,
+        "combined_pdf_base64": pybase64.b64encode(merged_pdf_bytes).decode("ascii"),
         "sharepoint_file_url": sharepoint_file_url
     }
 
@@ -594,7 +544,9 @@ async def process_timesheets(request: TimesheetRequest):
     # Log the incoming request for debugging
     logger.info(f"Received timesheet request: start_date={request.start_date}, end_date={request.end_date}")
     logger.info(f"Number of timesheets: {len(request.timesheets)}")
-    logger.info(f"Full request data: {request.model_dump()}")
+    # Dumping the whole payload is costly for large batches; only build it when debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Full request data: {request.model_dump()}")
     
     try:
         # Parse start and end dates
@@ -608,7 +560,11 @@ async def process_timesheets(request: TimesheetRequest):
             date_range.append(current_date.strftime("%d-%b-%Y"))
             current_date += timedelta(days=1)
         
-        # Process timesheets data
+        # Process timesheets data. Each employee row holds its daily hours in
+        # a list indexed by date_index rather than a per-row dict of dates.
+        date_index = {date: i for i, date in enumerate(date_range)}
+        # Dates not already in canonical form, normalized once each
+        normalized_dates = {}
         employee_data = {}
         
         for timesheet in request.timesheets:
@@ -628,7 +584,7 @@ async def process_timesheets(request: TimesheetRequest):
                     "employee_email": timesheet.employee_email,
                     "client_name": timesheet.client,
                     "job_number": timesheet.project_number,
-                    "daily_hours": {date: 0.0 for date in date_range},
+                    "daily_hours": [0.0] * len(date_range),
                     "total_hours": 0.0
                 }
             
@@ -637,19 +593,23 @@ async def process_timesheets(request: TimesheetRequest):
             
             # Only process if there are EGA Consultant hours
             if daily_total > 0:
-                # Normalize the timesheet date to match our date range format
-                timesheet_date = datetime.strptime(timesheet.date, "%d-%b-%Y").strftime("%d-%b-%Y")
+                # Normalize the timesheet date to match our date range format;
+                # dates already in that form need no strptime round trip
+                timesheet_date = timesheet.date
+                if timesheet_date not in date_index:
+                    if timesheet_date not in normalized_dates:
+                        normalized_dates[timesheet_date] = datetime.strptime(
+                            timesheet_date, "%d-%b-%Y"
+                        ).strftime("%d-%b-%Y")
+                    timesheet_date = normalized_dates[timesheet_date]
                 
                 # Add to the appropriate date
-                if timesheet_date in employee_data[key]["daily_hours"]:
-                    employee_data[key]["daily_hours"][timesheet_date] += daily_total
+                day = date_index.get(timesheet_date)
+                if day is not None:
+                    employee_data[key]["daily_hours"][day] += daily_total
                     employee_data[key]["total_hours"] += daily_total
         
         # Generate CSV content
-        output = StringIO()
-        writer = csv.writer(output)
-        
-        # Write header
         header = [
             "employee_first_name",
             "employee_last_name", 
@@ -657,27 +617,34 @@ async def process_timesheets(request: TimesheetRequest):
             "client_name",
             "job_number"
         ] + date_range + ["total_hours"]
-        
-        writer.writerow(header)
-        
-        # Write data rows
-        for employee in employee_data.values():
-            row = [
-                employee["employee_first_name"],
-                employee["employee_last_name"],
-                employee["employee_email"],
-                employee["client_name"],
-                employee["job_number"]
-            ] + [employee["daily_hours"][date] for date in date_range] + [employee["total_hours"]]
-            
-            writer.writerow(row)
-        
-        # Prepare response
-        output.seek(0)
-        csv_content = output.getvalue()
-        
+
+        async def csv_chunks():
+            # Rows are written to a small buffer that is flushed every
+            # CSV_CHUNK_ROWS rows, so the full CSV is never held in memory
+            output = StringIO()
+            writer = csv.writer(output)
+            writer.writerow(header)
+
+            # Write data rows
+            for count, employee in enumerate(employee_data.values(), 1):
+                row = [
+                    employee["employee_first_name"],
+                    employee["employee_last_name"],
+                    employee["employee_email"],
+                    employee["client_name"],
+                    employee["job_number"]
+                ] + employee["daily_hours"] + [employee["total_hours"]]
+                writer.writerow(row)
+
+                if count % CSV_CHUNK_ROWS == 0:
+                    yield output.getvalue().encode("utf-8")
+                    output.seek(0)
+                    output.truncate()
+
+            yield output.getvalue().encode("utf-8")
+
         return StreamingResponse(
-            BytesIO(csv_content.encode('utf-8')),
+            csv_chunks(),
             media_type="text/csv",
             headers={"Content-Disposition": "attachment; filename=timesheets.csv"}
         )
@@ -693,65 +660,536 @@ async def process_timesheets(request: TimesheetRequest):
 async def get_access_token():
     """
     Helper function to fetch an OAuth2 token using client_credentials flow.
+    The token is cached until shortly before it expires, so most calls
+    return without a round trip to the token endpoint.
     """
-    form_data = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "scope": "https://graph.microsoft.com/.default",
-        "grant_type": "client_credentials",
-    }
-    async with httpx.AsyncClient() as client:
-        token_resp = await client.post(TOKEN_URL, data=form_data)
+    if _token_cache["access_token"] and time.monotonic() < _token_cache["expires_at"]:
+        return _token_cache["access_token"]
+
+    async with _token_lock:
+        # Another request may have refreshed the token while we waited
+        if _token_cache["access_token"] and time.monotonic() < _token_cache["expires_at"]:
+            return _token_cache["access_token"]
+
+        token_resp = await get_client().post(
+            TOKEN_URL,
+            content=TOKEN_REQUEST_BODY,
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
         token_resp.raise_for_status()
-        return token_resp.json()["access_token"]
+        token_data = token_resp.json()
 
+        expires_in = float(token_data.get("expires_in", 3600))
+        _token_cache["access_token"] = token_data["access_token"]
+        _token_cache["expires_at"] = time.monotonic() + expires_in - TOKEN_EXPIRY_MARGIN_SECONDS
+        return _token_cache["access_token"]
 
-def build_folder_hierarchy(items):
+
+async def fetch_document_pdf(client: httpx.AsyncClient, server_id: str):
     """
-    Given a list of SharePoint 'items' from Graph,
-    build a nested folder structure based on parentReference.id.
+    Locate the Word document with this server_id and download it converted
+    to PDF by Graph. Returns the PDF as a spooled file positioned at the
+    start (the caller closes it) and the document's driveItem JSON.
+    """
+    # 1) Get the entire set of list items to locate this file,
+    #    fetching the token for the later Graph calls at the same time
+    access_token, folders = await asyncio.gather(
+        get_access_token(), get_folder_items(client)
+    )
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # 2) Find the file item
+    matching_node = folders["by_id"].get(server_id)
+    if not matching_node:
+        raise HTTPException(status_code=404, detail="Could not find an item with this server_id.")
+
+    if matching_node["contentType"] != "Document":
+        raise HTTPException(status_code=400, detail="The specified item is not a document.")
+
+    # 3) The driveItem (id and parent folder) comes expanded on the list item
+    drive_item_data = folders["drive_items"].get(server_id, {})
+    drive_item_id = drive_item_data.get("id")
+    if not drive_item_id:
+        raise HTTPException(status_code=400, detail="Could not retrieve driveItem.id for the file.")
+
+    # 4) Request the doc as PDF
+    pdf_url = (
+        f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DOCUMENTS_DRIVE_ID}"
+        f"/items/{drive_item_id}/content?format=pdf"
+    )
+    # Streamed into a spooled buffer so a large conversion spills to disk
+    # instead of being held in memory as one bytes object.
+    word_doc_pdf_file = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_BYTES)
+    async with client.stream("GET", pdf_url, headers=headers, follow_redirects=True) as pdf_resp:
+        if pdf_resp.status_code != 200:
+            await pdf_resp.aread()
+            word_doc_pdf_file.close()
+            raise HTTPException(
+                status_code=pdf_resp.status_code,
+                detail=f"Conversion failed. Graph error: {pdf_resp.text}",
+            )
+        try:
+            async for chunk in pdf_resp.aiter_bytes(PDF_DOWNLOAD_CHUNK_BYTES):
+                word_doc_pdf_file.write(chunk)
+        except BaseException:
+            # A dropped connection or a cancelled request must not leak the spool file
+            word_doc_pdf_file.close()
+            raise
+    word_doc_pdf_file.seek(0)
+    return word_doc_pdf_file, drive_item_data
+
+
+def merge_pdfs(doc_pdf_file, append_pdf_bytes: bytes) -> bytes:
+    """
+    Return a single PDF made of every page of doc_pdf_file (a binary file
+    object) followed by every page of append_pdf_bytes.
+    """
+    # Read the newly converted doc PDF
+    doc_pdf_reader = PdfReader(doc_pdf_file)
+    # Read the PDF to append
+    append_pdf_reader = PdfReader(BytesIO(append_pdf_bytes))
+
+    # Prepare a single writer and bulk-import both documents' pages
+    pdf_writer = PdfWriter()
+    pdf_writer.append(doc_pdf_reader)
+    pdf_writer.append(append_pdf_reader)
+
+    # Write to memory; getvalue() avoids the seek + read copy
+    merged_pdf_io = BytesIO()
+    pdf_writer.write(merged_pdf_io)
+    return merged_pdf_io.getvalue()
+
+
+async def upload_to_sharepoint(
+    client: httpx.AsyncClient,
+    file_name: str,
+    parent_id: str,
+    file_content: bytes | AsyncIterator[bytes],
+    content_length: int | None = None,
+):
+    """
+    PUTs raw file bytes into a SharePoint folder (parent driveItem id) and
+    returns the upload_file response: a browser viewer URL and the internal
+    delete_url. Shared by /upload_file, /upload_file_binary and
+    /convert_doc_to_pdf so callers that already hold bytes do not round-trip
+    them through base64.
+    file_content may also be an async iterator of chunks, which httpx streams;
+    pass content_length with it so the PUT is sent with a Content-Length
+    rather than chunked.
     """
-    nodes = {}
+    access_token = await get_access_token()
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/octet-stream"
+    }
+    if content_length is not None:
+        headers["Content-Length"] = str(content_length)
+
+    # Construct SharePoint file upload URL
+    upload_url = SHAREPOINT_UPLOAD_URL_TEMPLATE.format(
+        site_id=SITE_ID,
+        drive_id=DOCUMENTS_DRIVE_ID,    
+        parent_id=parent_id,
+        file_name=file_name
+    )
+
+    # Upload the file to SharePoint
+    response = await client.put(upload_url, headers=headers, content=file_content)
+
+    if response.status_code not in (200, 201):
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+    invalidate_folder_cache()
+
+    response_data = response.json()
+    
+    # Store the item ID for reliable deletion and construct a standard URL
+    item_id = response_data.get("id")
+    
+    # Get the parent path and filename to construct a consistent URL
+    parent_reference = response_data.get("parentReference", {})
+    parent_path = parent_reference.get("path", "").replace("/drive/root:", "")
+    file_name = response_data.get("name", file_name)
+    
+    # Construct a standard SharePoint document library URL format
+    # This format works for deletion regardless of file type
+    if parent_path:
+        file_path = f"{parent_path}/{file_name}"
+    else:
+        file_path = file_name
+    
+    # Remove leading slash if present
+    if file_path.startswith("/"):
+        file_path = file_path[1:]
+    
+    # Get the direct webUrl from SharePoint response
+    direct_web_url = response_data.get("webUrl")
+    
+    # Construct SharePoint viewer URL that opens in browser instead of downloading
+    if direct_web_url:
+        from urllib.parse import urlparse, quote, unquote
+        
+        # Get file extension to determine viewer URL format
+        file_extension = file_name.lower().split('.')[-1] if '.' in file_name else ''
+        
+        if file_extension in ['docx', 'doc', 'xlsx', 'xls', 'pptx', 'ppt']:
+            # For Office documents, SharePoint already returns the correct viewer URL
+            viewer_url = direct_web_url
+        else:
+            # For other files (like PDFs), modify the URL to open in browser view
+            parsed_url = urlparse(direct_web_url)
+            
+            # Check if it's already a viewer URL, if not, add web=1 parameter
+            if '?web=' not in direct_web_url and '&web=' not in direct_web_url:
+                separator = '&' if '?' in direct_web_url else '?'
+                viewer_url = f"{direct_web_url}{separator}web=1"
+            else:
+                viewer_url = direct_web_url
+    else:
+        # Construct fallback URL if webUrl is not available
+        viewer_url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DOCUMENTS_DRIVE_ID}/items/{item_id}"
+    
+    # Create internal file_url for deletion (with item_id)
+    internal_file_url = f"item_id:{item_id}|path:{file_path}"
+
+    return {
+        "message": "File uploaded successfully", 
+        "file_url": viewer_url,  # SharePoint viewer URL that opens in browser
+        "delete_url": internal_file_url  # Internal URL for deletion
+    }
+
+
+async def delete_from_sharepoint(client: httpx.AsyncClient, file_url: str):
+    """
+    Deletes one file given the delete_url returned from upload_file (or a
+    legacy webUrl) and returns the delete_file response. Shared by
+    /delete_file and /delete_files.
+    """
+    access_token = await get_access_token()
+    headers = {"Authorization": f"Bearer {access_token}"}
+    
+    try:
+        delete_url = None
+        
+        # Check if this is the new format with item_id
+        if file_url.startswith("item_id:"):
+            # Extract item_id from the new format
+            parts = file_url.split("|")
+            item_id = parts[0].replace("item_id:", "")
+            
+            # Use the item ID for direct deletion - more reliable
+            delete_url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DOCUMENTS_DRIVE_ID}/items/{item_id}"
+            
+            logger.info(f"Attempting to delete file by item ID: {item_id}")
+            
+        else:
+            # Legacy webUrl format - parse the URL to extract the relative path
+            from urllib.parse import urlparse, unquote
+            parsed_url = urlparse(file_url)
+            
+            # Extract the path after "Shared Documents" or "Documents"
+            path_parts = unquote(parsed_url.path).split('/')
+            
+            # Find the index of "Documents" in the path
+            docs_index = -1
+            for i, part in enumerate(path_parts):
+                if part in ["Documents", "Shared%20Documents", "Shared Documents"]:
+                    docs_index = i
+                    break
+            
+            if docs_index == -1:
+                raise HTTPException(status_code=400, detail="Invalid file URL format - could not find Documents folder")
+            
+            # Get the relative path after Documents
+            relative_path = '/'.join(path_parts[docs_index + 1:])
+            
+            if not relative_path:
+                raise HTTPException(status_code=400, detail="Invalid file URL - no file path found")
+            
+            # Construct the Graph API delete URL
+            delete_url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DOCUMENTS_DRIVE_ID}/root:/{relative_path}"
+            
+            logger.info(f"Attempting to delete file at path: {relative_path}")
+        
+        # Delete the file
+        response = await client.delete(delete_url, headers=headers)
+        
+        if response.status_code == 204:
+            invalidate_folder_cache()
+            return {"message": "File deleted successfully", "file_url": file_url}
+        elif response.status_code == 404:
+            raise HTTPException(status_code=404, detail="File not found")
+        else:
+            logger.error(f"Delete failed with status {response.status_code}: {response.text}")
+            response.raise_for_status()
+                
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error deleting file: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error deleting file: {str(e)}")
+
+
+def batch_results(outcomes):
+    """
+    Turn asyncio.gather(..., return_exceptions=True) outcomes from a batch
+    endpoint into per-file results: {"status_code": 200, "response": ...} on
+    success, or {"status_code": ..., "detail": ...} for the error that file hit.
+    """
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, HTTPException):
+            results.append({"status_code": outcome.status_code, "detail": outcome.detail})
+        elif isinstance(outcome, httpx.HTTPStatusError):
+            results.append({"status_code": outcome.response.status_code, "detail": outcome.response.text})
+        elif isinstance(outcome, Exception):
+            results.append({"status_code": 500, "detail": str(outcome)})
+        elif isinstance(outcome, BaseException):
+            raise outcome
+        else:
+            results.append({"status_code": 200, "response": outcome})
+    return results
+
+
+async def run_limited(semaphore: asyncio.Semaphore, coro):
+    """
+    Await coro once semaphore has a free slot.
+    """
+    async with semaphore:
+        return await coro
+
+
+async def iter_upload_file(upload: UploadFile, chunk_size: int = 1 << 20):
+    """
+    Yield an UploadFile's content in chunks so it can be streamed onwards
+    without reading the whole file into memory.
+    """
+    while chunk := await upload.read(chunk_size):
+        yield chunk
+
+
+async def get_folder_items(client: httpx.AsyncClient):
+    """
+    Return the cached view of the Documents list as a dict with:
+      - "items": the raw Graph list items
+      - "by_id": serverID -> hierarchy node
+      - "children_of": parent id -> nodes directly beneath it
+      - "drive_items": serverID -> expanded driveItem (id, parentReference)
+    Results are cached for FOLDER_CACHE_TTL_SECONDS; on expiry the list is
+    re-requested with the last ETag so Graph can answer 304 Not Modified,
+    and concurrent misses share a single fetch. If the cache is invalidated
+    while a fetch is in flight, its result is stored but left expired, since
+    it may predate the change.
+    """
+    if _folder_cache["entry"] is not None and time.monotonic() < _folder_cache["expires_at"]:
+        return _folder_cache["entry"]
+
+    async with _folder_cache_lock:
+        # Another request may have refreshed the cache while we waited
+        if _folder_cache["entry"] is not None and time.monotonic() < _folder_cache["expires_at"]:
+            return _folder_cache["entry"]
+
+        generation = _folder_cache["generation"]
+        access_token = await get_access_token()
+        headers = {"Authorization": f"Bearer {access_token}"}
+        if _folder_cache["entry"] is not None and _folder_cache["etag"]:
+            headers["If-None-Match"] = _folder_cache["etag"]
+
+        folder_resp = await client.get(FOLDER_LIST_URL, headers=headers)
+        if folder_resp.status_code != 304:
+            folder_resp.raise_for_status()
+            logger.debug(f"Fetched Documents list over {folder_resp.http_version}")
+            first_page = await decode_json(folder_resp.content)
+            etag = folder_resp.headers.get("ETag")
+            all_items = first_page.get("value", [])
+            list_bytes = len(folder_resp.content)
+            if first_page.get("@odata.nextLink"):
+                # A first-page ETag says nothing about later pages
+                etag = None
+                headers.pop("If-None-Match", None)
+                all_items, list_bytes = await fetch_remaining_pages(client, first_page, headers, list_bytes)
+            if list_bytes > OFFLOAD_PARSE_BYTES:
+                by_id, children_of, drive_items = await asyncio.to_thread(parse_items, all_items)
+            else:
+                by_id, children_of, drive_items = parse_items(all_items)
+            _folder_cache["entry"] = {
+                "items": all_items,
+                "by_id": by_id,
+                "children_of": children_of,
+                "drive_items": drive_items,
+                "json": {},  # memoised encodings, see encoded_folder_json
+                "json_bytes": 0,  # size of the memoised sub-tree encodings
+            }
+            _folder_cache["etag"] = etag
+
+        if _folder_cache["generation"] == generation:
+            _folder_cache["expires_at"] = time.monotonic() + FOLDER_CACHE_TTL_SECONDS
+        return _folder_cache["entry"]
+
+
+async def fetch_remaining_pages(
+    client: httpx.AsyncClient, first_page: dict, headers: dict, list_bytes: int
+):
+    """
+    Follow @odata.nextLink from an already-decoded first page and return the
+    'value' items of every page concatenated, plus the running total of body
+    bytes (starting from list_bytes). Each link is only known once the
+    previous page has been parsed, so pages are fetched in sequence.
+    """
+    all_items = list(first_page.get("value", []))
+    next_link = first_page.get("@odata.nextLink")
+    while next_link:
+        page_resp = await client.get(next_link, headers=headers)
+        page_resp.raise_for_status()
+        page = await decode_json(page_resp.content)
+        list_bytes += len(page_resp.content)
+        all_items.extend(page.get("value", []))
+        next_link = page.get("@odata.nextLink")
+    return all_items, list_bytes
+
+
+async def decode_json(body: bytes):
+    """
+    orjson.loads, moved to a worker thread for bodies over
+    OFFLOAD_PARSE_BYTES so a large list does not stall other requests.
+    """
+    if len(body) > OFFLOAD_PARSE_BYTES:
+        return await asyncio.to_thread(orjson.loads, body)
+    return orjson.loads(body)
+
+
+async def decode_base64(data: str) -> bytes:
+    """
+    pybase64.b64decode in a worker thread so large uploads do not stall the
+    event loop, with at most _base64_decode_semaphore decodes at a time.
+    """
+    async with _base64_decode_semaphore:
+        return await asyncio.to_thread(pybase64.b64decode, data, validate=False)
+
+
+def encoded_folder_json(folders: dict, server_id: str | None = None):
+    """
+    Return (payload, etag) for the JSON encoding of the whole hierarchy
+    (server_id=None) or of one node's sub-tree. Encodings are memoised on the
+    cache entry, so each is produced and hashed once per Graph refresh. The
+    whole hierarchy is always kept; sub-trees are kept up to
+    SUBTREE_JSON_CACHE_BYTES in total, oldest evicted first.
+    """
+    encoded = folders["json"].get(server_id)
+    if encoded is None:
+        # The root list is only needed here, so it is derived on first use
+        # rather than on every refresh
+        tree = hierarchy_roots(folders["by_id"]) if server_id is None else folders["by_id"][server_id]
+        payload = orjson.dumps(tree)
+        encoded = (payload, payload_etag(payload))
+        if server_id is None:
+            folders["json"][None] = encoded
+        elif len(payload) <= SUBTREE_JSON_CACHE_BYTES:
+            while folders["json_bytes"] + len(payload) > SUBTREE_JSON_CACHE_BYTES:
+                oldest = next(k for k in folders["json"] if k is not None)
+                folders["json_bytes"] -= len(folders["json"].pop(oldest)[0])
+            folders["json"][server_id] = encoded
+            folders["json_bytes"] += len(payload)
+    return encoded
+
+
+def payload_etag(payload: bytes) -> str:
+    """
+    Strong ETag for a response body.
+    """
+    return f'"{hashlib.md5(payload).hexdigest()}"'
+
+
+def json_payload_response(payload: bytes, etag: str, if_none_match: str | None) -> Response:
+    """
+    Return the pre-encoded JSON payload with ETag and Cache-Control headers,
+    or an empty 304 if the client already holds this version.
+    """
+    headers = {"ETag": etag, "Cache-Control": FOLDER_CACHE_CONTROL}
+    if if_none_match:
+        client_etags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in client_etags or "*" in client_etags:
+            return Response(status_code=304, headers=headers)
+    return Response(content=payload, media_type="application/json", headers=headers)
+
+
+def invalidate_folder_cache():
+    """
+    Force the next get_folder_items call to go back to Graph, including
+    when a fetch is already in flight.
+    """
+    _folder_cache["generation"] += 1
+    _folder_cache["expires_at"] = 0.0
+
+
+def parse_items(items, include_raw: bool = False):
+    """
+    Single pass over the SharePoint 'items' from Graph. Returns
+    (by_id, children_of, drive_items): by_id maps each serverID to its node,
+    children_of maps a parentReference.id to the nodes directly beneath it,
+    and drive_items maps each serverID to its expanded driveItem.
+    A node's "children" list is the same list object as children_of[serverID],
+    so the nested structure is complete once the pass finishes.
+    Nodes only carry the full Graph item under "rawItem" if include_raw is set.
+    """
+    by_id = {}
+    children_of = {}
+    drive_items = {}
 
     for item in items:
+        # '@odata.etag' looks like '"<guid>,<version>"'; slice out the GUID
+        # directly rather than strip + split into a throwaway list
         etag_str = item.get("@odata.etag", "")
-        server_id = etag_str.strip('"').split(",")[0]
+        comma = etag_str.find(",")
+        if comma > 0 and etag_str[0] == '"':
+            server_id = etag_str[1:comma]
+        else:
+            server_id = etag_str.strip('"').partition(",")[0]
         parent_id = item.get("parentReference", {}).get("id")  # parent's GUID
-        display_name = item.get("fields", {}).get("FileLeafRef")
+        fields = item.get("fields", {})
 
-        nodes[server_id] = {
-            "name": display_name,
+        node = {
+            "name": fields.get("FileLeafRef"),
             "serverID": server_id,
             "parentID": parent_id,
-            "children": [],
-            "rawItem": item,
+            "numericId": fields.get("id"),  # list item ID
+            "contentType": fields.get("ContentType"),
+            "children": children_of.setdefault(server_id, []),
         }
+        if include_raw:
+            node["rawItem"] = item
+        by_id[server_id] = node
+        children_of.setdefault(parent_id, []).append(node)
+        drive_items[server_id] = item.get("driveItem", {})
 
-    # Build hierarchy
-    roots = []
-    for sid, node in nodes.items():
-        pid = node["parentID"]
-        if pid and pid in nodes:
-            nodes[pid]["children"].append(node)
-        else:
-            roots.append(node)
+    return by_id, children_of, drive_items
 
-    return roots
+
+def hierarchy_roots(by_id):
+    """
+    Return the top-level nodes: those whose parent is not in the list.
+    """
+    return [node for node in by_id.values() if node["parentID"] not in by_id]
 
 
-def find_folder_by_id_in_hierarchy(tree, target_id: str):
+def build_folder_hierarchy(items, include_raw: bool = False):
     """
-    Recursively search the hierarchy (list of root nodes) for an item
-    whose 'serverID' matches 'target_id'. Return that node with children.
+    Given a list of SharePoint 'items' from Graph,
+    build a nested folder structure based on parentReference.id.
     """
-    for node in tree:
-        if node["serverID"] == target_id:
-            return node
-        result = find_folder_by_id_in_hierarchy(node["children"], target_id)
-        if result:
-            return result
-    return None
+    by_id, _, _ = parse_items(items, include_raw)
+    return hierarchy_roots(by_id)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # "auto" picks uvloop and httptools when they are installed (see requirements.txt).
+    # Each worker is a separate process with its own token and folder caches,
+    # and uvicorn needs the import string rather than the app object to spawn them.
+    workers = int(os.getenv("UVICORN_WORKERS", "1"))
+    uvicorn.run(
+        app if workers == 1 else "app:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=workers,
+    )
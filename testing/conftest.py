@@ -0,0 +1,23 @@
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--run-integration",
+        action="store_true",
+        default=False,
+        help="Run tests marked 'integration', which call the live SharePoint/Graph APIs.",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    """
+    Skip integration tests unless --run-integration was given, so a plain
+    `pytest` run makes no network calls.
+    """
+    if config.getoption("--run-integration"):
+        return
+    skip_integration = pytest.mark.skip(reason="needs --run-integration")
+    for item in items:
+        if "integration" in item.keywords:
+            item.add_marker(skip_integration)
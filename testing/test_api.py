@@ -1,12 +1,18 @@
-import os
 import pytest
-import base64
+import pybase64
+import orjson
 import time
+import itertools
+import asyncio
+import csv
+import io
+import httpx
 from fastapi.testclient import TestClient
 
 # We import the FastAPI 'app' from wherever your main code is.
 # Example: from main import app
-from app import app
+import app as app_module
+from app import app, get_client
 
 # The PDF file to append:
 PDF_TO_APPEND_PATH = "./testing/test_doc.pdf"
@@ -20,15 +26,61 @@ SERVER_ID = "e69033db-d82b-413f-a29b-6abf946564bf"
 # Server ID for upload/delete tests:
 UPLOAD_SERVER_ID = "0fa47696-8a49-4ad1-a4a1-886197849584"
 
+# Suffixes for uploaded file names: seeded from the clock so runs don't
+# collide, and counted so files within a run never share a name
+unique_ids = itertools.count(int(time.time()) * 1000)
+
 @pytest.fixture(scope="session")
 def client():
     """
     Provide a single TestClient instance for the entire test session.
+    Entering the context runs the app lifespan, which opens the shared httpx client.
+    """
+    with TestClient(app) as test_client:
+        yield test_client
+
+def read_payload(path):
+    """
+    Read a test file and return (raw bytes, base64 string).
+    """
+    try:
+        with open(path, "rb") as f:
+            file_bytes = f.read()
+    except FileNotFoundError:
+        pytest.fail(f"Cannot find test file: {path}")
+    return file_bytes, pybase64.b64encode(file_bytes).decode("ascii")
+
+def post_json(client, url, payload):
     """
-    return TestClient(app)
+    POST payload as JSON encoded with orjson. The base64 file data needs no
+    escaping, so this is close to a straight copy into the request body.
+    """
+    return client.post(url, content=orjson.dumps(payload), headers={"content-type": "application/json"})
+
+@pytest.fixture(scope="session")
+def pdf_payload():
+    """
+    The PDF test file as (bytes, base64), read and encoded once per session.
+    """
+    return read_payload(PDF_TO_APPEND_PATH)
+
+@pytest.fixture(scope="session")
+def docx_payload():
+    """
+    The DOCX test file as (bytes, base64), read and encoded once per session.
+    """
+    return read_payload(DOCX_TEST_PATH)
+
+@pytest.fixture(scope="session")
+def file_payloads(pdf_payload, docx_payload):
+    """
+    The test files' (bytes, base64) payloads keyed by file type, for tests
+    parametrized over "pdf" and "docx".
+    """
+    return {"pdf": pdf_payload, "docx": docx_payload}
 
 @pytest.mark.integration
-def test_convert_doc_to_pdf_integration(client):
+def test_convert_doc_to_pdf_integration(client, pdf_payload):
     """
     Integration test that:
     1) Calls the live '/convert_doc_to_pdf/{server_id}' endpoint with a real SharePoint doc.
@@ -37,13 +89,8 @@ def test_convert_doc_to_pdf_integration(client):
     4) Also checks the local file was 'saved' on the server side (the path returned in JSON).
     """
 
-    # 1) Read a local PDF -> base64
-    if not os.path.exists(PDF_TO_APPEND_PATH):
-        pytest.fail(f"Cannot find local PDF file to append: {PDF_TO_APPEND_PATH}")
-
-    with open(PDF_TO_APPEND_PATH, "rb") as f:
-        append_pdf_bytes = f.read()
-    append_pdf_b64 = base64.b64encode(append_pdf_bytes).decode("utf-8")
+    # 1) The local PDF as base64
+    _, append_pdf_b64 = pdf_payload
 
     # 2) Construct the payload
     payload = {
@@ -52,19 +99,20 @@ def test_convert_doc_to_pdf_integration(client):
 
     # 3) Make the POST request
     url = f"/convert_doc_to_pdf/{SERVER_ID}"
-    response = client.post(url, json=payload)
+    response = post_json(client, url, payload)
 
     # 4) Check results
     assert response.status_code == 200, f"Unexpected status code: {response.status_code}"
-    resp_data = response.json()
+    resp_data = orjson.loads(response.content)
 
     # Confirm the keys exist
     assert "combined_pdf_base64" in resp_data, "Should return 'combined_pdf_base64'."
 
-    # Decode the combined PDF and check it looks like PDF
+    # Check it looks like PDF; the header is in the first few bytes, so only
+    # the first 12 base64 characters (9 bytes) need decoding
     combined_pdf_b64 = resp_data["combined_pdf_base64"]
-    combined_pdf_bytes = base64.b64decode(combined_pdf_b64)
-    assert b"%PDF" in combined_pdf_bytes, "Merged PDF data should contain PDF header."
+    pdf_head = pybase64.b64decode(combined_pdf_b64[:12], validate=False)
+    assert pdf_head.startswith(b"%PDF"), "Merged PDF data should start with the PDF header."
 
     # Print out the SharePoint file URL returned by the API
     if "sharepoint_file_url" in resp_data:
@@ -72,148 +120,192 @@ def test_convert_doc_to_pdf_integration(client):
     else:
         print("Note: No SharePoint file URL returned")
 
-    # Optionally, you could write `combined_pdf_bytes` locally for verification:
+    # Optionally, you could decode the whole PDF and write it locally for verification:
     # with open("combined_test_output.pdf", "wb") as f:
-    #     f.write(combined_pdf_bytes)
+    #     f.write(pybase64.b64decode(combined_pdf_b64, validate=False))
 
     print("Integration test passed: The endpoint combined the PDFs and returned valid data.")
 
 
 @pytest.mark.integration
-def test_upload_file_integration(client):
+def test_convert_doc_to_pdf_raw_pdf_integration(client, pdf_payload):
+    """
+    Integration test that calls '/convert_doc_to_pdf/{server_id}?encoding=pdf'
+    and checks the combined PDF comes back as a raw application/pdf body.
+    """
+    _, append_pdf_b64 = pdf_payload
+
+    url = f"/convert_doc_to_pdf/{SERVER_ID}?encoding=pdf"
+    response = post_json(client, url, {"pdf_to_append_b64": append_pdf_b64})
+
+    assert response.status_code == 200, f"Unexpected status code: {response.status_code}"
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.content.startswith(b"%PDF"), "Response body should be PDF data."
+    print("SharePoint file URL:", response.headers.get("x-sharepoint-file-url"))
+
+
+@pytest.mark.integration
+@pytest.mark.xdist_group("sharepoint_upload")
+@pytest.mark.parametrize("file_type", ["pdf", "docx"])
+def test_upload_file_integration(client, file_payloads, file_type):
     """
     Integration test that:
-    1) Uploads test PDF and DOCX files to SharePoint using the upload_file endpoint
-    2) Verifies the uploads were successful and gets the file_urls
-    3) Writes the base64 encoded file data to txt files for verification
-    """
-    
-    # Test files to upload
-    test_files = [
-        {"path": PDF_TO_APPEND_PATH, "type": "pdf"},
-        {"path": DOCX_TEST_PATH, "type": "docx"}
-    ]
-    
-    for test_file in test_files:
-        file_path = test_file["path"]
-        file_type = test_file["type"]
-        
-        print(f"\n--- Testing {file_type.upper()} file upload ---")
-        
-        # 1) Prepare test file for upload
-        if not os.path.exists(file_path):
-            pytest.fail(f"Cannot find test {file_type} file for upload: {file_path}")
-        
-        with open(file_path, "rb") as f:
-            test_file_bytes = f.read()
-        test_file_b64 = base64.b64encode(test_file_bytes).decode("utf-8")
-        
-        # Write base64 encoded file as txt
-        base64_output_file = f"./testing/test_upload_{file_type}_base64_{int(time.time())}.txt"
-        with open(base64_output_file, "w") as f:
-            f.write(test_file_b64)
-        print(f"Base64 encoded {file_type} file written to: {base64_output_file}")
-        
-        # Generate a unique filename for this test
-        test_filename = f"test_upload_{file_type}_{int(time.time())}.{file_type}"
-        
-        # 2) Upload the file
-        upload_payload = {
-            "file_name": test_filename,
-            "server_id": UPLOAD_SERVER_ID,
-            "file_data": test_file_b64
-        }
-        
-        print(f"Uploading test {file_type} file: {test_filename}")
-        upload_response = client.post("/upload_file", json=upload_payload)
-        
-        # 3) Verify upload was successful
-        assert upload_response.status_code == 200, f"{file_type.upper()} upload failed with status: {upload_response.status_code}"
-        upload_data = upload_response.json()
-        
-        assert "message" in upload_data, f"{file_type.upper()} upload response should contain 'message'"
-        assert "file_url" in upload_data, f"{file_type.upper()} upload response should contain 'file_url'"
-        assert "delete_url" in upload_data, f"{file_type.upper()} upload response should contain 'delete_url'"
-        assert upload_data["message"] == "File uploaded successfully"
-        
-        file_url = upload_data["file_url"]
-        delete_url = upload_data["delete_url"]
-        print(f"{file_type.upper()} file uploaded successfully.")
-        print(f"Access URL: {file_url}")
-        print(f"Delete URL: {delete_url}")
-    
-    print("\nIntegration test passed: Both PDF and DOCX files were successfully uploaded.")
+    1) Uploads a test PDF or DOCX file to SharePoint using the upload_file endpoint
+    2) Verifies the upload was successful and gets the file_url
+    """
+    
+    _, test_file_b64 = file_payloads[file_type]
+    print(f"\n--- Testing {file_type.upper()} file upload ---")
+    
+    # Generate a unique filename for this test
+    test_filename = f"test_upload_{file_type}_{next(unique_ids)}.{file_type}"
+    
+    # 1) Upload the file
+    upload_payload = {
+        "file_name": test_filename,
+        "server_id": UPLOAD_SERVER_ID,
+        "file_data": test_file_b64
+    }
+    
+    print(f"Uploading test {file_type} file: {test_filename}")
+    upload_response = post_json(client, "/upload_file", upload_payload)
+    
+    # 2) Verify upload was successful
+    assert upload_response.status_code == 200, f"{file_type.upper()} upload failed with status: {upload_response.status_code}"
+    upload_data = orjson.loads(upload_response.content)
+    
+    assert "message" in upload_data, f"{file_type.upper()} upload response should contain 'message'"
+    assert "file_url" in upload_data, f"{file_type.upper()} upload response should contain 'file_url'"
+    assert "delete_url" in upload_data, f"{file_type.upper()} upload response should contain 'delete_url'"
+    assert upload_data["message"] == "File uploaded successfully"
+    
+    file_url = upload_data["file_url"]
+    delete_url = upload_data["delete_url"]
+    print(f"{file_type.upper()} file uploaded successfully.")
+    print(f"Access URL: {file_url}")
+    print(f"Delete URL: {delete_url}")
+
+    print(f"\nIntegration test passed: The {file_type.upper()} file was successfully uploaded.")
 
 
 @pytest.mark.integration
-def test_delete_file_integration(client):
+@pytest.mark.xdist_group("sharepoint_upload")
+def test_upload_file_binary_integration(client, pdf_payload):
+    """
+    Integration test that uploads the test PDF as a raw multipart file
+    through the upload_file_binary endpoint.
+    """
+    pdf_bytes, _ = pdf_payload
+    test_filename = f"test_upload_binary_{next(unique_ids)}.pdf"
+    upload_response = client.post(
+        "/upload_file_binary",
+        data={"server_id": UPLOAD_SERVER_ID, "file_name": test_filename},
+        files={"file": (test_filename, pdf_bytes, "application/pdf")},
+    )
+
+    assert upload_response.status_code == 200, f"Binary upload failed with status: {upload_response.status_code}"
+    upload_data = orjson.loads(upload_response.content)
+    assert upload_data["message"] == "File uploaded successfully"
+    assert "file_url" in upload_data
+    assert "delete_url" in upload_data
+    print(f"Access URL: {upload_data['file_url']}")
+
+
+@pytest.mark.integration
+@pytest.mark.xdist_group("sharepoint_upload")
+@pytest.mark.parametrize("file_type", ["pdf", "docx"])
+def test_delete_file_integration(client, file_payloads, file_type):
     """
     Integration test that:
-    1) Uploads test PDF and DOCX files to SharePoint first
-    2) Deletes the uploaded files using the delete_file endpoint
-    3) Verifies the deletions were successful
-    """
-    
-    # Test files to upload and then delete
-    test_files = [
-        {"path": PDF_TO_APPEND_PATH, "type": "pdf"},
-        {"path": DOCX_TEST_PATH, "type": "docx"}
-    ]
-    
-    for test_file in test_files:
-        file_path = test_file["path"]
-        file_type = test_file["type"]
-        
-        print(f"\n--- Testing {file_type.upper()} file deletion ---")
-        
-        # 1) First upload a file to have something to delete
-        if not os.path.exists(file_path):
-            pytest.fail(f"Cannot find test {file_type} file for upload: {file_path}")
-        
-        with open(file_path, "rb") as f:
-            test_file_bytes = f.read()
-        test_file_b64 = base64.b64encode(test_file_bytes).decode("utf-8")
-        
-        # Generate a unique filename for this test
-        test_filename = f"test_delete_{file_type}_{int(time.time())}.{file_type}"
-        
-        # Upload the file first
-        upload_payload = {
-            "file_name": test_filename,
-            "server_id": UPLOAD_SERVER_ID,
-            "file_data": test_file_b64
-        }
-        
-        print(f"Uploading test {file_type} file for deletion: {test_filename}")
-        upload_response = client.post("/upload_file", json=upload_payload)
-        
-        assert upload_response.status_code == 200, f"{file_type.upper()} upload failed with status: {upload_response.status_code}"
-        upload_data = upload_response.json()
-        file_url = upload_data["file_url"]
-        delete_url = upload_data["delete_url"]
-        print(f"{file_type.upper()} file uploaded successfully for deletion test.")
-        print(f"Access URL: {file_url}")
-        print(f"Delete URL: {delete_url}")
-        
-        # 2) Delete the uploaded file using the delete_url
-        delete_payload = {
-            "file_url": delete_url  # Using delete_url for deletion
-        }
-        
-        print(f"Deleting uploaded {file_type} file using delete_url...")
-        delete_response = client.post("/delete_file", json=delete_payload)
-        
-        # 3) Verify deletion was successful
-        assert delete_response.status_code == 200, f"{file_type.upper()} delete failed with status: {delete_response.status_code}"
-        delete_data = delete_response.json()
-        
-        assert "message" in delete_data, f"{file_type.upper()} delete response should contain 'message'"
-        assert delete_data["message"] == "File deleted successfully"
-        assert delete_data["file_url"] == delete_url, f"{file_type.upper()} delete response should return the same delete_url"
-        
-        print(f"{file_type.upper()} file was successfully deleted.")
-    
-    print("\nIntegration test passed: Both PDF and DOCX files were successfully deleted.")
+    1) Uploads a test PDF or DOCX file to SharePoint first
+    2) Deletes the uploaded file using the delete_file endpoint
+    3) Verifies the deletion was successful
+    """
+    
+    _, test_file_b64 = file_payloads[file_type]
+    print(f"\n--- Testing {file_type.upper()} file deletion ---")
+    
+    # 1) First upload a file to have something to delete
+    # Generate a unique filename for this test
+    test_filename = f"test_delete_{file_type}_{next(unique_ids)}.{file_type}"
+    
+    # Upload the file first
+    upload_payload = {
+        "file_name": test_filename,
+        "server_id": UPLOAD_SERVER_ID,
+        "file_data": test_file_b64
+    }
+    
+    print(f"Uploading test {file_type} file for deletion: {test_filename}")
+    upload_response = post_json(client, "/upload_file", upload_payload)
+    
+    assert upload_response.status_code == 200, f"{file_type.upper()} upload failed with status: {upload_response.status_code}"
+    upload_data = orjson.loads(upload_response.content)
+    file_url = upload_data["file_url"]
+    delete_url = upload_data["delete_url"]
+    print(f"{file_type.upper()} file uploaded successfully for deletion test.")
+    print(f"Access URL: {file_url}")
+    print(f"Delete URL: {delete_url}")
+    
+    # 2) Delete the uploaded file using the delete_url
+    delete_payload = {
+        "file_url": delete_url  # Using delete_url for deletion
+    }
+    
+    print(f"Deleting uploaded {file_type} file using delete_url...")
+    delete_response = client.post("/delete_file", json=delete_payload)
+    
+    # 3) Verify deletion was successful
+    assert delete_response.status_code == 200, f"{file_type.upper()} delete failed with status: {delete_response.status_code}"
+    delete_data = orjson.loads(delete_response.content)
+    
+    assert "message" in delete_data, f"{file_type.upper()} delete response should contain 'message'"
+    assert delete_data["message"] == "File deleted successfully"
+    assert delete_data["file_url"] == delete_url, f"{file_type.upper()} delete response should return the same delete_url"
+    
+    print(f"{file_type.upper()} file was successfully deleted.")
+
+    print(f"\nIntegration test passed: The {file_type.upper()} file was successfully deleted.")
+
+
+@pytest.mark.integration
+@pytest.mark.xdist_group("sharepoint_upload")
+def test_upload_and_delete_files_batch_integration(client, pdf_payload, docx_payload):
+    """
+    Integration test that uploads the PDF and DOCX test files in a single
+    '/upload_files' call, then removes both with a single '/delete_files' call.
+    """
+    test_files = [("pdf", pdf_payload), ("docx", docx_payload)]
+    upload_payload = {
+        "files": [
+            {
+                "file_name": f"test_batch_{file_type}_{next(unique_ids)}.{file_type}",
+                "server_id": UPLOAD_SERVER_ID,
+                "file_data": test_file_b64,
+            }
+            for file_type, (_, test_file_b64) in test_files
+        ]
+    }
+
+    upload_response = post_json(client, "/upload_files", upload_payload)
+    assert upload_response.status_code == 200, f"Batch upload failed with status: {upload_response.status_code}"
+    upload_data = orjson.loads(upload_response.content)
+    assert len(upload_data) == len(test_files)
+    for result in upload_data:
+        assert result["status_code"] == 200, f"Batch upload of one file failed: {result}"
+        assert result["response"]["message"] == "File uploaded successfully"
+        print(f"Access URL: {result['response']['file_url']}")
+
+    delete_urls = [result["response"]["delete_url"] for result in upload_data]
+    delete_response = client.post("/delete_files", json={"file_urls": delete_urls})
+    assert delete_response.status_code == 200, f"Batch delete failed with status: {delete_response.status_code}"
+    delete_data = orjson.loads(delete_response.content)
+    assert [result["status_code"] for result in delete_data] == [200] * len(delete_urls)
+    assert [result["response"]["file_url"] for result in delete_data] == delete_urls
+    for result in delete_data:
+        assert result["response"]["message"] == "File deleted successfully"
+
+    print("\nIntegration test passed: Both files were uploaded and deleted in batch calls.")
 
 
 @pytest.mark.integration
@@ -223,7 +315,7 @@ def test_delete_nonexistent_file(client):
     """
     
     # Use a fake file URL that doesn't exist
-    fake_file_url = f"https://example.sharepoint.com/sites/test/Shared%20Documents/nonexistent_file_{int(time.time())}.pdf"
+    fake_file_url = f"https://example.sharepoint.com/sites/test/Shared%20Documents/nonexistent_file_{next(unique_ids)}.pdf"
     
     delete_payload = {
         "file_url": fake_file_url
@@ -234,8 +326,444 @@ def test_delete_nonexistent_file(client):
     # Should return 404 for non-existent file
     assert delete_response.status_code == 404, f"Expected 404 for non-existent file, got: {delete_response.status_code}"
     
-    delete_data = delete_response.json()
+    delete_data = orjson.loads(delete_response.content)
     assert "detail" in delete_data
     assert "not found" in delete_data["detail"].lower()
     
     print("Test passed: Non-existent file deletion properly returns 404.")
+
+
+def mock_list_item(server_id: str, parent_id: str, name: str, numeric_id: str):
+    """
+    A Documents list item for a folder, shaped like Graph's reply to FOLDER_LIST_URL.
+    """
+    return {
+        "@odata.etag": f'"{server_id},1"',
+        "parentReference": {"id": parent_id},
+        "fields": {"id": numeric_id, "FileLeafRef": name, "ContentType": "Folder"},
+        "driveItem": {"id": f"drive-{numeric_id}", "parentReference": {"id": "drive-root"}},
+    }
+
+MOCK_LIST_ITEMS = [
+    mock_list_item("root-folder", "library", "Projects", "1"),
+    mock_list_item("child-folder", "root-folder", "Project A", "2"),
+]
+
+def mock_graph_handler(request: httpx.Request, list_items: list):
+    """
+    Stand-in for Graph in the non-integration tests: the Documents list is
+    list_items, and a folder created under a parent is added to it. PUTs
+    whose file name contains 'fail' return 500, DELETEs of items whose id
+    contains 'missing' return 404, and everything else succeeds.
+    """
+    if request.method == "GET" and request.url.path.endswith("/lists/Documents/items"):
+        return httpx.Response(200, json={"value": list_items})
+    if request.method == "POST" and request.url.path.endswith("/children"):
+        parent_id = request.url.path.rsplit("/", 2)[1]
+        name = orjson.loads(request.content)["name"]
+        list_items.append(mock_list_item(f"folder-{len(list_items) + 1}", parent_id, name, str(len(list_items) + 1)))
+        return httpx.Response(201, json={"id": f"drive-{len(list_items)}", "name": name, "folder": {}})
+    if request.method == "PUT":
+        if "fail" in request.url.path:
+            return httpx.Response(500, text="upload rejected")
+        file_name = request.url.path.rsplit(":/", 2)[1]
+        return httpx.Response(201, json={
+            "id": f"id-{file_name}",
+            "name": file_name,
+            "parentReference": {"path": "/drive/root:/Batch"},
+            "webUrl": f"https://example.sharepoint.com/Shared%20Documents/Batch/{file_name}",
+        })
+    if request.method == "DELETE":
+        return httpx.Response(404 if "missing" in request.url.path else 204)
+    return httpx.Response(500, text=f"unexpected request {request.method} {request.url}")
+
+@pytest.fixture
+def mock_graph(client, monkeypatch):
+    """
+    Route the app's Graph calls to mock_graph_handler (starting from a copy
+    of MOCK_LIST_ITEMS) and skip the token request, with an empty Documents
+    list cache that is put back afterwards. Yields the list of requests Graph
+    received.
+    """
+    received = []
+    list_items = list(MOCK_LIST_ITEMS)
+
+    def handler(request):
+        received.append(request)
+        return mock_graph_handler(request, list_items)
+
+    async def fake_access_token():
+        return "test-token"
+
+    mock_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(app_module, "get_access_token", fake_access_token)
+    monkeypatch.setattr(app_module, "_folder_cache", {"entry": None, "etag": None, "expires_at": 0.0, "generation": 0})
+    app.dependency_overrides[get_client] = lambda: mock_client
+    yield received
+    app.dependency_overrides.pop(get_client, None)
+    asyncio.run(mock_client.aclose())
+
+
+def test_upload_files_reports_each_file(client, mock_graph):
+    """
+    A failed upload in '/upload_files' is reported for that file only; the
+    other files are still uploaded and their delete_urls returned.
+    """
+    upload_payload = {
+        "files": [
+            {"file_name": name, "server_id": UPLOAD_SERVER_ID, "file_data": pybase64.b64encode(b"data").decode("ascii")}
+            for name in ["first.pdf", "fail.pdf", "last.pdf"]
+        ]
+    }
+    response = post_json(client, "/upload_files", upload_payload)
+
+    assert response.status_code == 200
+    results = orjson.loads(response.content)
+    assert [result["status_code"] for result in results] == [200, 500, 200]
+    assert results[0]["response"]["delete_url"].startswith("item_id:id-first.pdf|")
+    assert results[1]["detail"] == "upload rejected"
+    assert results[2]["response"]["delete_url"].startswith("item_id:id-last.pdf|")
+    assert len(mock_graph) == 3
+
+
+def test_upload_files_invalid_base64_uploads_nothing(client, mock_graph):
+    """
+    Invalid base64 in any file fails '/upload_files' with a 400 before a
+    single file is sent to SharePoint.
+    """
+    upload_payload = {
+        "files": [
+            {"file_name": "good.pdf", "server_id": UPLOAD_SERVER_ID, "file_data": pybase64.b64encode(b"data").decode("ascii")},
+            {"file_name": "bad.pdf", "server_id": UPLOAD_SERVER_ID, "file_data": "A"},
+        ]
+    }
+    response = post_json(client, "/upload_files", upload_payload)
+
+    assert response.status_code == 400
+    assert "bad.pdf" in orjson.loads(response.content)["detail"]
+    assert mock_graph == []
+
+
+def test_batch_endpoints_reject_oversized_batches(client, mock_graph):
+    """
+    More than BATCH_MAX_FILES files is a 422, with nothing sent to SharePoint.
+    """
+    too_many = app_module.BATCH_MAX_FILES + 1
+    upload_payload = {
+        "files": [
+            {"file_name": f"{i}.pdf", "server_id": UPLOAD_SERVER_ID, "file_data": pybase64.b64encode(b"data").decode("ascii")}
+            for i in range(too_many)
+        ]
+    }
+    assert post_json(client, "/upload_files", upload_payload).status_code == 422
+    assert post_json(client, "/delete_files", {"file_urls": [f"item-{i}" for i in range(too_many)]}).status_code == 422
+    assert mock_graph == []
+
+
+def test_delete_files_limits_concurrency(monkeypatch):
+    """
+    A batch sends at most BATCH_CONCURRENCY requests to Graph at a time.
+    """
+    in_flight = 0
+    peak = 0
+
+    async def handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(204)
+
+    async def fake_access_token():
+        return "test-token"
+
+    async def delete_batch():
+        request = app_module.DeleteFilesRequest(file_urls=[f"item_id:item-{i}" for i in range(app_module.BATCH_MAX_FILES)])
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as mock_client:
+            return await app_module.delete_files(request, mock_client)
+
+    monkeypatch.setattr(app_module, "get_access_token", fake_access_token)
+    monkeypatch.setattr(app_module, "_folder_cache", {"entry": None, "etag": None, "expires_at": 0.0, "generation": 0})
+    results = asyncio.run(delete_batch())
+
+    assert [result["status_code"] for result in results] == [200] * app_module.BATCH_MAX_FILES
+    assert peak == app_module.BATCH_CONCURRENCY
+
+
+def test_delete_files_reports_each_file(client, mock_graph):
+    """
+    '/delete_files' returns a result per file, so a missing file does not
+    hide that the others were deleted.
+    """
+    file_urls = ["item_id:kept-1|path:Batch/a.pdf", "item_id:missing|path:Batch/b.pdf"]
+    response = client.post("/delete_files", json={"file_urls": file_urls})
+
+    assert response.status_code == 200
+    results = orjson.loads(response.content)
+    assert [result["status_code"] for result in results] == [200, 404]
+    assert results[0]["response"]["file_url"] == file_urls[0]
+    assert results[1]["detail"] == "File not found"
+    assert len(mock_graph) == 2
+
+
+def test_folder_cache_invalidated_during_fetch_stays_expired(monkeypatch):
+    """
+    A Documents list fetch that overlaps invalidate_folder_cache() (e.g. an
+    upload landing meanwhile) must not be cached as fresh: the next call
+    goes back to Graph.
+    """
+    list_requests = []
+
+    def handler(request):
+        list_requests.append(request)
+        if len(list_requests) == 1:
+            app_module.invalidate_folder_cache()
+        return httpx.Response(200, json={"value": []})
+
+    async def fake_access_token():
+        return "test-token"
+
+    async def fetch_twice():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as mock_client:
+            await app_module.get_folder_items(mock_client)
+            await app_module.get_folder_items(mock_client)
+
+    monkeypatch.setattr(app_module, "get_access_token", fake_access_token)
+    monkeypatch.setattr(app_module, "_folder_cache", {"entry": None, "etag": None, "expires_at": 0.0, "generation": 0})
+    asyncio.run(fetch_twice())
+
+    assert len(list_requests) == 2
+
+
+def test_folder_items_follow_next_link(monkeypatch):
+    """
+    A Documents list split over pages is followed via @odata.nextLink and
+    merged. The first page's ETag is dropped, since it does not cover later
+    pages, and later pages are requested without If-None-Match.
+    """
+    list_requests = []
+    second_page_url = "https://graph.microsoft.com/v1.0/next-page?$skiptoken=2"
+
+    def handler(request):
+        list_requests.append(request)
+        if str(request.url) == second_page_url:
+            return httpx.Response(200, json={"value": [MOCK_LIST_ITEMS[1]]})
+        return httpx.Response(
+            200,
+            json={"value": [MOCK_LIST_ITEMS[0]], "@odata.nextLink": second_page_url},
+            headers={"ETag": '"first-page"'},
+        )
+
+    async def fake_access_token():
+        return "test-token"
+
+    async def fetch():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as mock_client:
+            return await app_module.get_folder_items(mock_client)
+
+    # An expired entry with an ETag, so the first page is a conditional request
+    stale_cache = {"entry": {"items": []}, "etag": '"stale"', "expires_at": 0.0, "generation": 0}
+    monkeypatch.setattr(app_module, "get_access_token", fake_access_token)
+    monkeypatch.setattr(app_module, "_folder_cache", stale_cache)
+    folders = asyncio.run(fetch())
+
+    assert set(folders["by_id"]) == {"root-folder", "child-folder"}
+    assert app_module._folder_cache["etag"] is None
+    assert len(list_requests) == 2
+    assert list_requests[0].headers["If-None-Match"] == '"stale"'
+    assert "If-None-Match" not in list_requests[1].headers
+
+
+def test_access_token_single_flight(monkeypatch):
+    """
+    Concurrent callers with no cached token share a single token request.
+    """
+    token_requests = []
+
+    async def handler(request):
+        token_requests.append(request)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"access_token": "fresh-token", "expires_in": 3600})
+
+    async def fetch_tokens():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as mock_client:
+            monkeypatch.setattr(app_module, "http_client", mock_client)
+            return await asyncio.gather(*(app_module.get_access_token() for _ in range(10)))
+
+    monkeypatch.setattr(app_module, "_token_cache", {"access_token": None, "expires_at": 0.0})
+    monkeypatch.setattr(app_module, "_token_lock", asyncio.Lock())
+    tokens = asyncio.run(fetch_tokens())
+
+    assert tokens == ["fresh-token"] * 10
+    assert len(token_requests) == 1
+
+
+def test_subtree_json_memo_is_byte_bounded(monkeypatch):
+    """
+    Memoised sub-tree encodings stay within SUBTREE_JSON_CACHE_BYTES, oldest
+    evicted first, and a sub-tree over the whole budget is not kept; the
+    whole-hierarchy encoding is always kept.
+    """
+    items = MOCK_LIST_ITEMS + [mock_list_item("sibling-folder", "root-folder", "Project B", "3")]
+    by_id, children_of, drive_items = app_module.parse_items(items)
+    folders = {"by_id": by_id, "json": {}, "json_bytes": 0}
+    sizes = {server_id: len(orjson.dumps(by_id[server_id])) for server_id in by_id}
+    # Room for either sibling, but not both
+    budget = sizes["child-folder"] + sizes["sibling-folder"] - 1
+    monkeypatch.setattr(app_module, "SUBTREE_JSON_CACHE_BYTES", budget)
+
+    root_payload, _ = app_module.encoded_folder_json(folders)
+    app_module.encoded_folder_json(folders, "child-folder")
+    app_module.encoded_folder_json(folders, "sibling-folder")
+    assert set(folders["json"]) == {None, "sibling-folder"}
+    assert folders["json_bytes"] == sizes["sibling-folder"]
+
+    assert sizes["root-folder"] > budget
+    app_module.encoded_folder_json(folders, "root-folder")
+    assert set(folders["json"]) == {None, "sibling-folder"}
+    assert folders["json"][None][0] == root_payload
+
+
+TIMESHEET_DATES = ["01-Jan-2025", "02-Jan-2025", "03-Jan-2025"]
+
+def timesheet(employee: int, date: str, hours: float, other_hours: float = 0.0):
+    """
+    One timesheet entry for employee number 'employee', with 'hours' of
+    EGA Consultant time (counted) and 'other_hours' of another type (ignored).
+    Tests keep hours to multiples of 0.25 so float sums are exact in any order.
+    """
+    return {
+        "client": f"Client {employee % 7}",
+        "project_number": f"P{employee}",
+        "date": date,
+        "employee_first_name": f"First{employee}",
+        "employee_last_name": f"Last{employee}",
+        "employee_email": f"employee{employee}@example.com",
+        "employee_unique_id": str(employee),
+        "time_entries": [
+            {"total_time": hours, "type": "EGA Consultant"},
+            {"total_time": other_hours, "type": "Travel"},
+        ],
+    }
+
+def expected_timesheet_csv(timesheets):
+    """
+    The CSV /process_timesheets should return for 'timesheets' over
+    TIMESHEET_DATES, built independently of the endpoint.
+    """
+    rows = {}
+    for entry in timesheets:
+        key = (entry["employee_first_name"], entry["employee_last_name"], entry["employee_email"],
+               entry["client"], entry["project_number"])
+        hours = rows.setdefault(key, {date: 0.0 for date in TIMESHEET_DATES})
+        ega_hours = sum(t["total_time"] for t in entry["time_entries"] if t["type"] == "EGA Consultant")
+        date = time.strftime("%d-%b-%Y", time.strptime(entry["date"], "%d-%b-%Y"))
+        if ega_hours > 0 and date in hours:
+            hours[date] += ega_hours
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["employee_first_name", "employee_last_name", "employee_email", "client_name", "job_number"]
+                    + TIMESHEET_DATES + ["total_hours"])
+    for key, hours in rows.items():
+        daily = [hours[date] for date in TIMESHEET_DATES]
+        writer.writerow(list(key) + daily + [sum(daily)])
+    return output.getvalue().encode("utf-8")
+
+
+@pytest.mark.parametrize("employees", [3, app_module.CSV_CHUNK_ROWS * 2, app_module.CSV_CHUNK_ROWS * 2 + 201])
+def test_process_timesheets_csv(client, employees):
+    """
+    '/process_timesheets' returns the full CSV however many CSV_CHUNK_ROWS
+    chunks it streams in (including an exact multiple), sums repeat entries,
+    ignores non-consultant time and dates outside the range, and accepts
+    non-canonical dates like '3-Jan-2025'.
+    """
+    timesheets = []
+    for employee in range(employees):
+        timesheets.append(timesheet(employee, TIMESHEET_DATES[employee % 3], 1.5 + employee % 4, other_hours=2.0))
+        timesheets.append(timesheet(employee, "3-Jan-2025", 0.25))
+    timesheets.append(timesheet(0, "02-Jan-2025", 3.0))
+    timesheets.append(timesheet(1, "04-Jan-2025", 8.0))  # outside the range
+    timesheets.append(timesheet(employees, "01-Jan-2025", 0.0))  # no consultant hours: row of zeros
+
+    response = client.post("/process_timesheets", json={
+        "start_date": TIMESHEET_DATES[0],
+        "end_date": TIMESHEET_DATES[-1],
+        "timesheets": timesheets,
+    })
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.headers["content-disposition"] == "attachment; filename=timesheets.csv"
+    assert response.content == expected_timesheet_csv(timesheets)
+    assert response.content.count(b"\r\n") == employees + 2
+
+
+def test_process_timesheets_invalid_date(client):
+    """
+    An unparseable timesheet date is a 400, not a 500 or a truncated CSV.
+    """
+    response = client.post("/process_timesheets", json={
+        "start_date": TIMESHEET_DATES[0],
+        "end_date": TIMESHEET_DATES[-1],
+        "timesheets": [timesheet(0, "2025-01-02", 1.0)],
+    })
+
+    assert response.status_code == 400
+    assert orjson.loads(response.content)["detail"].startswith("Date parsing error")
+
+
+def test_folders_revalidate_with_etag(client, mock_graph):
+    """
+    '/folders' and '/subfolders' send an ETag and answer a matching
+    If-None-Match (strong, weak or '*') with an empty 304, and anything
+    else with the full body.
+    """
+    response = client.get("/folders")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "private, no-cache"
+    assert [node["name"] for node in orjson.loads(response.content)] == ["Projects"]
+
+    for if_none_match in [etag, f"W/{etag}", f'"stale", {etag}', "*"]:
+        revalidated = client.get("/folders", headers={"If-None-Match": if_none_match})
+        assert revalidated.status_code == 304, if_none_match
+        assert revalidated.content == b""
+        assert revalidated.headers["etag"] == etag
+
+    changed = client.get("/folders", headers={"If-None-Match": '"stale"'})
+    assert changed.status_code == 200
+    assert changed.content == response.content
+
+    subfolder = client.get("/subfolders/child-folder")
+    assert subfolder.status_code == 200
+    assert orjson.loads(subfolder.content)["name"] == "Project A"
+    subfolder_etag = subfolder.headers["etag"]
+    assert subfolder_etag != etag
+    assert client.get("/subfolders/child-folder", headers={"If-None-Match": subfolder_etag}).status_code == 304
+
+    # All of the above was served from one cached list fetch
+    assert len(mock_graph) == 1
+
+
+def test_folders_change_after_create_folder(client, mock_graph):
+    """
+    Creating a folder invalidates the cached list, so the next '/folders'
+    goes back to Graph and a revalidation with the old ETag gets the new tree.
+    """
+    response = client.get("/folders")
+    etag = response.headers["etag"]
+
+    created = client.post("/create_folder", json={"parent_folder_id": "root-folder", "folder_name": "Project B"})
+    assert created.status_code == 200
+
+    refreshed = client.get("/folders", headers={"If-None-Match": etag})
+    assert refreshed.status_code == 200
+    assert refreshed.headers["etag"] != etag
+    projects = orjson.loads(refreshed.content)[0]
+    assert sorted(child["name"] for child in projects["children"]) == ["Project A", "Project B"]
+
+    list_requests = [request for request in mock_graph if request.method == "GET"]
+    assert len(list_requests) == 2